@@ -2,23 +2,21 @@ from slack_bolt.async_app import AsyncApp
 from slack_bolt.adapter.fastapi.async_handler import AsyncSlackRequestHandler
 import os
 from dotenv import load_dotenv
-import requests
+import httpx
 from fastapi import FastAPI, Request, Depends
-from fastapi.responses import JSONResponse
-import json
+from fastapi.responses import ORJSONResponse, Response
+import orjson
 import logging
 import sys
+import asyncio
 from datetime import datetime
 import re
-from sqlalchemy.orm import Session
-from sqlalchemy import desc
-from db.database import engine, SessionLocal
-from db.models import Base, Conversation
+from contextlib import asynccontextmanager
+from sqlalchemy import text, update
+from db.database import engine, AsyncSessionLocal
+from db.models import Base, Conversation, SCHEMA_UPGRADES, CONCURRENT_INDEXES
 from utils.util import *
 
-# Create database tables
-Base.metadata.create_all(bind=engine)
-
 # Configure logging
 logging.basicConfig(
     level=logging.INFO,
@@ -35,24 +33,126 @@ SLACK_TOKEN = os.getenv("SLACK_TOKEN", "")
 SLACK_SIGNING_SECRET = os.getenv("SLACK_SIGNING_SECRET", "")
 CHAT_ENDPOINT = os.getenv("CHAT_ENDPOINT", "")
 MODEL_NAME = os.getenv("MODEL_NAME", "")
+CONTEXT_TOKENS = int(os.getenv("CONTEXT_TOKENS", "4096"))
 REQUEST_TIMEOUT = 120  # Timeout in seconds
 
+# Static prompt parts, kept at module scope so every prompt starts with the same prefix
+SYSTEM_PREAMBLE = (
+    "You are an AI Coach, world-class semiconductor value chain expert with extensive and in-depth knowledge of semiconductor manufacturing. "
+    "You need to help your team of users to become expert problem-solvers in this field by providing answers and reasoning to the questions "
+    "which the user asks in the most accurate form by demonstrating your technical skills and depth. "
+    "Be conversational, friendly and professional in your response.\n\n"
+    "Here is some context to the conversation, based on the previous conversations:\n"
+)
+QUESTION_PREFIX = "\n\nPlease answer the below question now\n\n### Question: "
+
 # Debug logging for environment variables
 logger.info(f"Loaded environment variables:")
 logger.info(f"SLACK_TOKEN: {'*' * len(SLACK_TOKEN) if SLACK_TOKEN else 'Not set'}")
 logger.info(f"SLACK_SIGNING_SECRET: {'*' * len(SLACK_SIGNING_SECRET) if SLACK_SIGNING_SECRET else 'Not set'}")
 logger.info(f"CHAT_ENDPOINT: {CHAT_ENDPOINT}")
 logger.info(f"MODEL_NAME: {MODEL_NAME}")
+logger.info(f"CONTEXT_TOKENS: {CONTEXT_TOKENS}")
 
 # Initialize the async app with your bot token and signing secret
 app = AsyncApp(token=SLACK_TOKEN, signing_secret=SLACK_SIGNING_SECRET)
 app_handler = AsyncSlackRequestHandler(app)
 
+# Shared HTTP client for the chat endpoint, reused across requests
+http_client = httpx.AsyncClient(timeout=httpx.Timeout(REQUEST_TIMEOUT))
+
+# Keep references to fire-and-forget tasks so they are not garbage collected
+background_tasks = set()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Create database tables
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+        for statement in SCHEMA_UPGRADES:
+            await conn.execute(text(statement))
+    # CREATE INDEX CONCURRENTLY cannot run inside a transaction
+    async with engine.connect() as conn:
+        conn = await conn.execution_options(isolation_level="AUTOCOMMIT")
+        for name, statement in CONCURRENT_INDEXES.items():
+            try:
+                # An interrupted build leaves an invalid index that IF NOT EXISTS would keep
+                result = await conn.execute(
+                    text(
+                        "SELECT NOT i.indisvalid FROM pg_index i "
+                        "JOIN pg_class c ON c.oid = i.indexrelid WHERE c.relname = :name"
+                    ),
+                    {"name": name}
+                )
+                if result.scalar():
+                    await conn.execute(text(f"DROP INDEX CONCURRENTLY IF EXISTS {name}"))
+                await conn.execute(text(statement))
+            except Exception as e:
+                logger.error(f"Error creating index {name}: {str(e)}")
+    yield
+    # Let pending background inserts finish before closing the database pool
+    await asyncio.gather(*background_tasks, return_exceptions=True)
+    # Close the shared HTTP client and database pool on shutdown
+    await http_client.aclose()
+    await engine.dispose()
+
 # Create FastAPI app
-fastapi_app = FastAPI()
+fastapi_app = FastAPI(lifespan=lifespan, default_response_class=ORJSONResponse)
+
+def run_in_background(coro):
+    task = asyncio.create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+
+# Store a conversation in its own session and return its id
+async def store_conversation(event, incoming_message, outgoing_message, model_name):
+    async with AsyncSessionLocal() as session:
+        try:
+            conversation = Conversation(
+                user_id=event.get("user"),
+                channel_id=event.get("channel"),
+                message_id=event.get("ts"),
+                incoming_message=incoming_message,
+                outgoing_message=outgoing_message,
+                model_name=model_name
+            )
+            session.add(conversation)
+            await session.commit()
+            logger.info("Stored conversation in database")
+            # The primary key is populated from INSERT ... RETURNING
+            return conversation.id
+        except Exception as e:
+            logger.error(f"Error storing conversation: {str(e)}")
+            await session.rollback()
+            return None
+
+# Load the conversation context in its own session
+async def load_context(channel_id):
+    async with AsyncSessionLocal() as session:
+        return await get_recent_conversations(session, channel_id, MODEL_NAME, CONTEXT_TOKENS)
 
-# Create a database session
-db = SessionLocal()
+# Store the model response and append the turn to the memory pack
+async def store_response(conversation_id, channel_id, question, response_text):
+    # Extract the answer once and store it alongside the raw response
+    _, answer = extract_think_and_answer(response_text)
+    async with AsyncSessionLocal() as session:
+        try:
+            # Update the existing conversation with the response
+            if conversation_id is not None:
+                await session.execute(
+                    update(Conversation)
+                    .where(Conversation.id == conversation_id)
+                    .values(outgoing_message=response_text, outgoing_answer=answer)
+                )
+                await session.commit()
+                logger.info("Updated conversation with response in database")
+            else:
+                logger.error("Could not find conversation to update")
+        except Exception as e:
+            logger.error(f"Error updating conversation with response: {str(e)}")
+            await session.rollback()
+        
+        await append_conversation_turn(session, channel_id, MODEL_NAME, question, answer, CONTEXT_TOKENS)
 
 # Listen to regular messages in channels and DMs
 @app.event("message")
@@ -63,22 +163,9 @@ async def handle_message(event, say):
     if text:
         # Clean the message
         cleaned_text = clean_message(text)
-        logger.info(f"Echoing message: {cleaned_text}")
-        try:
-            # Store the conversation in database
-            conversation = Conversation(
-                user_id=event.get("user"),
-                channel_id=event.get("channel"),
-                message_id=event.get("ts"),
-                incoming_message=cleaned_text,
-                outgoing_message=cleaned_text,
-                model_name="echo"
-            )
-            db.add(conversation)
-            db.commit()
-        except Exception as e:
-            logger.error(f"Error storing conversation: {str(e)}")
-            db.rollback()
+        logger.info("Echoing message: %s", cleaned_text)
+        # Store the conversation without delaying the reply
+        run_in_background(store_conversation(event, cleaned_text, cleaned_text, "echo"))
         # Simply echo back the message
         await say(cleaned_text)
 
@@ -90,38 +177,17 @@ async def handle_mention(event, say):
         try:
             # Clean the message
             cleaned_text = clean_message(text)
-            logger.info(f"Processing mention: {cleaned_text}")
-            
-            # Store the incoming message first
-            try:
-                conversation = Conversation(
-                    user_id=event.get("user"),
-                    channel_id=event.get("channel"),
-                    message_id=event.get("ts"),
-                    incoming_message=cleaned_text,
-                    outgoing_message="",  # Empty for now, will be updated later
-                    model_name=MODEL_NAME
-                )
-                db.add(conversation)
-                db.commit()
-                logger.info("Stored incoming message in database")
-            except Exception as e:
-                logger.error(f"Error storing incoming message: {str(e)}")
-                db.rollback()
+            logger.info("Processing mention: %s", cleaned_text)
             
-            # Get recent conversations for context
-            context = get_recent_conversations(db, event.get("channel"), MODEL_NAME)
-            logger.info(f"Context from recent conversations: {context}")
+            # Store the incoming message while loading the context
+            conversation_id, context = await asyncio.gather(
+                store_conversation(event, cleaned_text, "", MODEL_NAME),  # Response is stored later
+                load_context(event.get("channel"))
+            )
+            logger.debug("Context from recent conversations: %s", context)
             
-            # Prepare the prompt with context
-            prompt = f"""You are an AI Coach, world-class semiconductor value chain expert with extensive and in-depth knowledge of semiconductor manufacturing. You need to help your team of users to become expert problem-solvers in this field by providing answers and reasoning to the questions which the user asks in the most accurate form by demonstrating your technical skills and depth. Be conversational, friendly and professional in your response.
-
-                    Here is some context to the conversation, based on the previous conversations:
-                    {context}
-
-                    Please answer the below question now
-
-                    ### Question: {cleaned_text}"""
+            # Prepare the prompt with context, keeping the leading part stable across turns
+            prompt = "".join([SYSTEM_PREAMBLE, context, QUESTION_PREFIX, cleaned_text])
             
             # Send message to external endpoint with correct format
             payload = {
@@ -133,72 +199,73 @@ async def handle_mention(event, say):
                 "Content-Type": "application/json"
             }
             
-            response = requests.post(
+            response = await http_client.post(
                 CHAT_ENDPOINT, 
-                json=payload, 
-                headers=headers,
-                timeout=REQUEST_TIMEOUT
+                content=orjson.dumps(payload), 
+                headers=headers
             )
             response.raise_for_status()
             
             # Get the response from the endpoint
-            response_data = response.json()
+            response_data = orjson.loads(response.content)
             response_text = response_data.get("response", "")
-            logger.info(f"Response received from endpoint: {response_text}")
-            
-            try:
-                # Update the existing conversation with the response
-                conversation = db.query(Conversation).filter_by(message_id=event.get("ts")).first()
-                if conversation:
-                    conversation.outgoing_message = response_text
-                    db.commit()
-                    logger.info("Updated conversation with response in database")
-                else:
-                    logger.error("Could not find conversation to update")
-            except Exception as e:
-                logger.error(f"Error updating conversation with response: {str(e)}")
-                db.rollback()
+            logger.debug("Response received from endpoint: %s", response_text)
             
-            # Format and send the response
+            # Store the response while sending it to Slack
             formatted_response = format_slack_response(response_text)
-            await say(**formatted_response)
+            await asyncio.gather(
+                store_response(conversation_id, event.get("channel"), cleaned_text, response_text),
+                say(**formatted_response)
+            )
             
-        except requests.exceptions.Timeout:
+        except httpx.TimeoutException:
             logger.error(f"Request timed out after {REQUEST_TIMEOUT} seconds")
             await say("Sorry, the request took too long to process. Please try again.")
-        except requests.exceptions.RequestException as e:
+        except httpx.HTTPError as e:
             logger.error(f"Error connecting to endpoint: {str(e)}")
             await say("Sorry, I'm having trouble connecting to the chat service right now.")
+        except orjson.JSONDecodeError as e:
+            logger.error(f"Invalid JSON response from endpoint: {str(e)}")
+            await say("Sorry, I'm having trouble connecting to the chat service right now.")
 
 # Handle all Slack events
 @fastapi_app.post("/slack/events")
 async def slack_events(request: Request):
-    # Get the raw request body and decode it
+    # Get the raw request body; Starlette caches it for the Slack handler
     body = await request.body()
+    
+    # Reject forged or replayed requests before any parsing
+    if not verify_slack_signature(
+        SLACK_SIGNING_SECRET,
+        body,
+        request.headers.get("X-Slack-Request-Timestamp"),
+        request.headers.get("X-Slack-Signature")
+    ):
+        logger.warning("Rejected request with invalid Slack signature")
+        return ORJSONResponse(status_code=401, content={"error": "Invalid signature"})
+    
     try:
-        # Decode bytes to string and parse JSON
-        body_str = body.decode('utf-8')
-        data = json.loads(body_str)
-        
-        # Handle URL verification challenge
-        if data.get("type") == "url_verification":
-            logger.info("Handling URL verification challenge")
-            return JSONResponse(content={"challenge": data["challenge"]})
+        # Only parse JSON for URL verification, the Slack handler parses everything else
+        if b'"url_verification"' in body and b'"challenge"' in body:
+            data = orjson.loads(body)
+            if data.get("type") == "url_verification":
+                logger.info("Handling URL verification challenge")
+                return Response(content=orjson.dumps({"challenge": data["challenge"]}), media_type="application/json")
         
         # Debug logging for request headers
-        headers = dict(request.headers)
-        logger.info(f"Request headers: {headers}")
-        logger.info(f"Signing secret length: {len(SLACK_SIGNING_SECRET)}")
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Request headers: %s", dict(request.headers))
+            logger.debug("Signing secret length: %d", len(SLACK_SIGNING_SECRET))
         
         # Handle all other events
         return await app_handler.handle(request)
         
-    except json.JSONDecodeError as e:
+    except orjson.JSONDecodeError as e:
         logger.error(f"Error decoding JSON: {str(e)}")
-        return JSONResponse(status_code=400, content={"error": "Invalid JSON"})
+        return ORJSONResponse(status_code=400, content={"error": "Invalid JSON"})
     except Exception as e:
         logger.error(f"Error processing request: {str(e)}")
-        return JSONResponse(status_code=500, content={"error": "Internal server error"})
+        return ORJSONResponse(status_code=500, content={"error": "Internal server error"})
 
 # Log startup
 logger.info("Slack bot application initialized") 
\ No newline at end of file
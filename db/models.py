@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, DateTime, Text
+from sqlalchemy import Column, Integer, String, DateTime, Text, JSON, UniqueConstraint, Index
 from sqlalchemy.sql import func
 from db.database import Base
 
@@ -11,6 +11,39 @@ class Conversation(Base):
     message_id = Column(String, unique=True, index=True)
     incoming_message = Column(Text)
     outgoing_message = Column(Text)
+    outgoing_answer = Column(Text)  # outgoing_message without the <think> sections
     model_name = Column(String)
     created_at = Column(DateTime(timezone=True), server_default=func.now())
-    updated_at = Column(DateTime(timezone=True), onupdate=func.now()) 
\ No newline at end of file
+    updated_at = Column(DateTime(timezone=True), onupdate=func.now())
+
+    __table_args__ = (
+        # Serves the recent conversations lookup by channel and model, newest first
+        Index("ix_conv_channel_model_created", channel_id, model_name, created_at.desc()),
+    )
+
+class ConversationContext(Base):
+    __tablename__ = "conversation_contexts"
+    __table_args__ = (
+        UniqueConstraint("channel_id", "model_name", name="uq_conversation_contexts_channel_model"),
+    )
+
+    id = Column(Integer, primary_key=True, index=True)
+    channel_id = Column(String, nullable=False)
+    model_name = Column(String, nullable=False)
+    turns = Column(JSON, nullable=False)
+    version = Column(Integer, nullable=False, default=1)  # Write counter only, not used for concurrency control
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+    updated_at = Column(DateTime(timezone=True), onupdate=func.now())
+
+# Idempotent schema changes for tables that create_all does not alter, applied at startup
+SCHEMA_UPGRADES = [
+    "ALTER TABLE conversations ADD COLUMN IF NOT EXISTS outgoing_answer TEXT",
+]
+
+# Indexes added to existing tables at startup, built CONCURRENTLY so writes are not blocked
+CONCURRENT_INDEXES = {
+    "ix_conv_channel_model_created": (
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_conv_channel_model_created "
+        "ON conversations (channel_id, model_name, created_at DESC)"
+    ),
+}
@@ -1,9 +1,17 @@
 import re
-from sqlalchemy.orm import Session
-from db.models import Conversation
-from sqlalchemy import desc
+import hmac
+import hashlib
+import time
+from sqlalchemy.ext.asyncio import AsyncSession
+from db.models import Conversation, ConversationContext
+from sqlalchemy import desc, select, func
+from sqlalchemy.dialects.postgresql import insert as pg_insert
 import logging
-from typing import Dict, Tuple, List, Optional
+import asyncio
+import weakref
+from collections import deque
+from cachetools import LRUCache
+from typing import Deque, Dict, Tuple, List, Optional
 
 logger = logging.getLogger(__name__)
 
@@ -12,6 +20,30 @@ SLACK_USER_MENTION_PATTERN = r'<@[A-Z0-9]+>'
 THINK_TAG_PATTERN = r'<think>(.*?)</think>'
 BOLD_TEXT_PATTERN = r'\*\*(.*?)\*\*'
 
+# Precompiled regex patterns
+_USER_MENTION_RE = re.compile(SLACK_USER_MENTION_PATTERN)
+_THINK_RE = re.compile(THINK_TAG_PATTERN, re.DOTALL)
+_BOLD_RE = re.compile(BOLD_TEXT_PATTERN)
+
+# Maximum age of a signed Slack request in seconds
+SLACK_SIGNATURE_MAX_AGE = 60 * 5
+
+# Context windows of (question, answer) turns keyed by (channel_id, model_id).
+# These are the source of truth for the context and the stored pack is a blind
+# overwrite from them. Appends are serialized per key with _context_locks, so
+# packs are stored in order within a process, but this assumes a single worker
+# process: with several workers (e.g. uvicorn --workers) each keeps its own
+# window and turns are lost.
+CONTEXT_WINDOWS = LRUCache(maxsize=1000)
+
+# Per-key locks held while appending to and storing a window; dropped when unused
+_context_locks = weakref.WeakValueDictionary()
+
+# Context sizing
+MAX_CONTEXT_TURNS = 50  # Candidate turns kept per window
+CONTEXT_BUDGET_RATIO = 0.8  # Share of the model context window used for history
+CONTEXT_LOW_WATER_RATIO = 0.5  # Share of the turn limit and token budget kept after a trim
+
 def clean_message(text: str) -> str:
     """Remove user mentions and clean the message text.
     
@@ -25,12 +57,44 @@ def clean_message(text: str) -> str:
         logger.warning(f"Invalid input type for clean_message: {type(text)}")
         return str(text)
         
+    # Skip the regex when there are no mentions
+    if '<@' not in text:
+        return text.strip()
+    
     # Remove user mentions in the format <@U...>
-    cleaned_text = re.sub(SLACK_USER_MENTION_PATTERN, '', text)
+    cleaned_text = _USER_MENTION_RE.sub('', text)
     # Remove any leading/trailing whitespace
     cleaned_text = cleaned_text.strip()
     return cleaned_text
 
+def verify_slack_signature(signing_secret: str, body: bytes, timestamp: Optional[str], signature: Optional[str]) -> bool:
+    """Check the Slack request signature against the raw request body.
+    
+    Args:
+        signing_secret (str): The Slack app signing secret
+        body (bytes): The raw request body
+        timestamp (Optional[str]): The X-Slack-Request-Timestamp header
+        signature (Optional[str]): The X-Slack-Signature header
+        
+    Returns:
+        bool: True if the signature matches and the request is recent
+    """
+    if not signing_secret or not timestamp or not signature:
+        return False
+    try:
+        if abs(time.time() - int(timestamp)) > SLACK_SIGNATURE_MAX_AGE:
+            return False
+    except (ValueError, OverflowError):
+        return False
+    
+    expected = "v0=" + hmac.new(
+        signing_secret.encode(),
+        b"v0:" + timestamp.encode() + b":" + body,
+        hashlib.sha256
+    ).hexdigest()
+    # Compare bytes, since compare_digest rejects non-ASCII str and headers may hold any characters
+    return hmac.compare_digest(expected.encode(), signature.encode("utf-8", "replace"))
+
 def extract_think_and_answer(response_text: str) -> Tuple[Optional[List[str]], str]:
     """Extract the thinking part and answer from the response text.
     
@@ -47,16 +111,19 @@ def extract_think_and_answer(response_text: str) -> Tuple[Optional[List[str]], s
         return None, str(response_text)
         
     try:
-        # Find all content between <think> tags
-        think_matches = re.finditer(THINK_TAG_PATTERN, response_text, re.DOTALL)
-        thinking_parts = [match.group(1).strip() for match in think_matches]
+        # Split once: odd items are <think> contents, the last item is the trailing text
+        parts = _THINK_RE.split(response_text)
+        thinking_parts = [part.strip() for part in parts[1::2]]
         
-        # Get everything after the last </think> tag
-        think_end = response_text.rfind('</think>')
+        # Get everything after the last </think> tag, which may be unpaired
+        tail = parts[-1]
+        think_end = tail.rfind('</think>')
         if think_end == -1:
-            return None, response_text.strip()
+            if len(parts) == 1:
+                return None, response_text.strip()
+            return thinking_parts, tail.strip()
         
-        answer = response_text[think_end + 8:].strip()
+        answer = tail[think_end + 8:].strip()
         return thinking_parts, answer
     except Exception as e:
         logger.error(f"Error extracting think and answer: {str(e)}")
@@ -74,38 +141,51 @@ def chunk_text(text: str, max_length: int = 2900) -> List[str]:
         List[str]: List of text chunks
     """
     chunks = []
-    while text:
-        if len(text) <= max_length:
-            chunks.append(text)
+    pos = 0
+    n = len(text)
+    while pos < n:
+        if n - pos <= max_length:
+            chunks.append(text[pos:n])
             break
         
         # Find the last complete sentence within max_length
-        chunk_end = max_length
-        last_period = text[:max_length].rfind('.')
-        last_newline = text[:max_length].rfind('\n')
-        last_space = text[:max_length].rfind(' ')
+        window_end = pos + max_length
+        chunk_end = window_end
+        last_period = text.rfind('.', pos, window_end)
+        last_newline = text.rfind('\n', pos, window_end)
+        last_space = text.rfind(' ', pos, window_end)
         
         # Try to split at the most appropriate boundary
-        if last_period != -1 and last_period > max_length * 0.7:  # Only use period if it's not too far back
+        if last_period != -1 and last_period - pos > max_length * 0.7:  # Only use period if it's not too far back
             chunk_end = last_period + 1
-        elif last_newline != -1 and last_newline > max_length * 0.7:  # Only use newline if it's not too far back
+        elif last_newline != -1 and last_newline - pos > max_length * 0.7:  # Only use newline if it's not too far back
             chunk_end = last_newline + 1
         elif last_space != -1:  # Always better to split at a space than mid-word
             chunk_end = last_space + 1
             
         # If no good splitting point found, find the next space after max_length
-        if chunk_end == max_length and len(text) > max_length:
-            next_space = text.find(' ', max_length)
-            if next_space != -1 and next_space - max_length < 100:  # Don't extend too far
+        if chunk_end == window_end:
+            next_space = text.find(' ', window_end, min(window_end + 100, n))  # Don't extend too far
+            if next_space != -1:
                 chunk_end = next_space + 1
         
-        current_chunk = text[:chunk_end].strip()
+        current_chunk = text[pos:chunk_end].strip()
         if current_chunk:  # Only add non-empty chunks
             chunks.append(current_chunk)
-        text = text[chunk_end:].strip()
+        
+        # Skip whitespace around the split point instead of re-slicing the remainder
+        pos = chunk_end
+        while pos < n and text[pos].isspace():
+            pos += 1
+        while n > pos and text[n - 1].isspace():
+            n -= 1
     
     return chunks
 
+def _section(text: str) -> Dict:
+    """Build a Slack mrkdwn section block."""
+    return {"type": "section", "text": {"type": "mrkdwn", "text": text}}
+
 def format_slack_response(response_text: str) -> Dict:
     """Format the response with collapsible thinking section and proper text formatting.
     
@@ -126,86 +206,182 @@ def format_slack_response(response_text: str) -> Dict:
         
         # Only add thinking process section if there are thinking parts
         if thinking_parts:
-            blocks.append({
-                "type": "section",
-                "text": {
-                    "type": "mrkdwn",
-                    "text": "*Thinking Process* :arrow_down:"
-                }
-            })
+            blocks.append(_section("*Thinking Process* :arrow_down:"))
             
             # Split thinking parts into chunks if needed
-            for part in thinking_parts:
-                chunks = chunk_text(part)
-                for chunk in chunks:
-                    blocks.append({
-                        "type": "section",
-                        "text": {
-                            "type": "mrkdwn",
-                            "text": f"```{chunk}```"
-                        }
-                    })
+            blocks.extend([_section(f"```{chunk}```") for part in thinking_parts for chunk in chunk_text(part)])
             
-            blocks.append({
-                "type": "divider"
-            })
+            blocks.append({"type": "divider"})
         
         # Format the answer text to handle bold formatting
-        formatted_answer = re.sub(BOLD_TEXT_PATTERN, r'*\1*', answer)
+        formatted_answer = _BOLD_RE.sub(r'*\1*', answer)
         
         # Split answer into chunks if needed
-        blocks.append({
-            "type": "section",
-            "text": {
-                "type": "mrkdwn",
-                "text": "*Answer:*"
-            }
-        })
-        
-        answer_chunks = chunk_text(formatted_answer)
-        for chunk in answer_chunks:
-            blocks.append({
-                "type": "section",
-                "text": {
-                    "type": "mrkdwn",
-                    "text": chunk
-                }
-            })
+        blocks.append(_section("*Answer:*"))
+        blocks.extend([_section(chunk) for chunk in chunk_text(formatted_answer)])
         
         return {"blocks": blocks}
     except Exception as e:
         logger.error(f"Error formatting Slack response: {str(e)}")
         return {"text": str(response_text)}
 
-def get_recent_conversations(db: Session, channel_id: str, model_id: str, limit: int = 5) -> str:
-    """Get recent conversations and format them as context.
+def _format_turn(question: str, answer: str) -> str:
+    """Format a single user/assistant turn of the memory pack."""
+    return f"user: \"{question}\"\nassistant: \"{answer}\""
+
+def _turn_tokens(question: str, answer: str) -> int:
+    """Estimate the tokens of a turn at one token per four characters."""
+    return (len(question) + len(answer)) // 4
+
+def _trim_context_window(window: Deque[Tuple[str, str]], limit: int, budget: int) -> None:
+    """Drop the oldest turns once the window exceeds its turn limit or token budget.
+    
+    The window is trimmed down to ``CONTEXT_LOW_WATER_RATIO`` of both limits rather
+    than just below them, so it stays unchanged until the next time a limit is hit.
+    The newest turn is always kept if it fits in ``budget`` on its own.
+    
+    Args:
+        window (Deque[Tuple[str, str]]): The (question, answer) turns, oldest first
+        limit (int): Maximum number of turns
+        budget (int): Maximum number of estimated tokens
+    """
+    used = sum(_turn_tokens(question, answer) for question, answer in window)
+    if len(window) <= limit and used <= budget:
+        return
+    
+    low_turns = max(int(CONTEXT_LOW_WATER_RATIO * limit), 1)
+    low_tokens = int(CONTEXT_LOW_WATER_RATIO * budget)
+    while window and (len(window) > low_turns or used > low_tokens):
+        if len(window) == 1 and used <= budget:
+            break
+        question, answer = window.popleft()
+        used -= _turn_tokens(question, answer)
+
+async def _get_context_window(db: AsyncSession, channel_id: str, model_id: str, limit: int, budget: int) -> Deque[Tuple[str, str]]:
+    """Get the in-memory context window for a channel and model, hydrating it on a miss.
+    
+    A hydrated window is trimmed to ``limit`` and ``budget`` before it is shared.
     
     Args:
-        db (Session): SQLAlchemy database session
+        db (AsyncSession): SQLAlchemy async database session
+        channel_id (str): The Slack channel ID of the window
+        model_id (str): The model ID of the window
+        limit (int): Maximum number of turns, also used to seed a new window
+        budget (int): Maximum number of estimated tokens
+        
+    Returns:
+        Deque[Tuple[str, str]]: The (question, answer) turns, oldest first
+    """
+    cache_key = (channel_id, model_id)
+    window = CONTEXT_WINDOWS.get(cache_key)
+    if window is not None:
+        return window
+    
+    result = await db.execute(
+        select(ConversationContext).where(
+            ConversationContext.channel_id == channel_id,
+            ConversationContext.model_name == model_id
+        )
+    )
+    pack = result.scalars().first()
+    if pack:
+        turns = [(question, answer) for question, answer in pack.turns]
+    else:
+        # Seed a new window once from the stored conversation history
+        result = await db.execute(
+            select(Conversation).where(
+                Conversation.channel_id == channel_id,
+                Conversation.model_name == model_id,
+                Conversation.outgoing_message != ""
+            ).order_by(desc(Conversation.created_at)).limit(limit)
+        )
+        turns = []
+        for conv in reversed(result.scalars().all()):  # Reverse to get chronological order
+            answer = conv.outgoing_answer
+            if answer is None:
+                # Rows stored before outgoing_answer existed
+                _, answer = extract_think_and_answer(conv.outgoing_message)
+            turns.append((conv.incoming_message, answer))
+    
+    window = deque(turns)
+    _trim_context_window(window, limit, budget)
+    
+    # Keep the first window if a concurrent miss hydrated it already
+    return CONTEXT_WINDOWS.setdefault(cache_key, window)
+
+async def get_recent_conversations(db: AsyncSession, channel_id: str, model_id: str, context_tokens: int = 4096, limit: int = MAX_CONTEXT_TURNS) -> str:
+    """Get the memory pack of recent conversations formatted as context.
+    
+    The pack is trimmed only by ``append_conversation_turn``, when it exceeds
+    ``limit`` turns or ``CONTEXT_BUDGET_RATIO`` of ``context_tokens`` (one token per
+    four characters). Trimming drops turns from the head down to
+    ``CONTEXT_LOW_WATER_RATIO`` of those limits, keeping the newest turn if it fits,
+    so consecutive prompts share a stable prefix between trims. The trade-off is
+    that after a trim the context holds noticeably less history than the budget allows.
+    
+    Args:
+        db (AsyncSession): SQLAlchemy async database session
         channel_id (str): The Slack channel ID to filter conversations
         model_id (str): The model ID to filter conversations
-        limit (int, optional): Number of recent conversations to fetch. Defaults to 5.
+        context_tokens (int, optional): Context window size of the model. Defaults to 4096.
+        limit (int, optional): Maximum number of candidate turns. Defaults to MAX_CONTEXT_TURNS.
         
     Returns:
         str: Formatted context string from recent conversations
     """
     try:
-        # Get recent conversations ordered by timestamp, filtered by channel_id and model_id
-        conversations = db.query(Conversation).filter(
-            Conversation.channel_id == channel_id,
-            Conversation.model_name == model_id
-        ).order_by(desc(Conversation.created_at)).limit(limit).all()
-        
-        # Format conversations as context
-        context_parts = []
-        for conv in reversed(conversations):  # Reverse to get chronological order
-            # Extract only the answer part from the outgoing message
-            _, answer = extract_think_and_answer(conv.outgoing_message)
-            context_parts.append(f"user: \"{conv.incoming_message}\"")
-            context_parts.append(f"assistant: \"{answer}\"")
-        
-        # Join with newlines
-        return "\n".join(context_parts)
+        window = await _get_context_window(db, channel_id, model_id, limit, int(CONTEXT_BUDGET_RATIO * context_tokens))
+        return "\n".join(_format_turn(question, answer) for question, answer in window)
     except Exception as e:
         logger.error(f"Error fetching recent conversations: {str(e)}")
-        return ""
\ No newline at end of file
+        return ""
+
+async def append_conversation_turn(db: AsyncSession, channel_id: str, model_id: str, question: str, answer: str, context_tokens: int = 4096, limit: int = MAX_CONTEXT_TURNS) -> None:
+    """Append a user/assistant turn to the context window and store the memory pack.
+    
+    The oldest turns are dropped once the window holds more than ``limit`` turns or
+    ``CONTEXT_BUDGET_RATIO`` of ``context_tokens``, down to ``CONTEXT_LOW_WATER_RATIO``
+    of those limits. The stored pack is exactly what the next prompt will contain.
+    
+    Args:
+        db (AsyncSession): SQLAlchemy async database session
+        channel_id (str): The Slack channel ID of the pack
+        model_id (str): The model ID of the pack
+        question (str): The cleaned user message
+        answer (str): The answer part of the model response
+        context_tokens (int, optional): Context window size of the model. Defaults to 4096.
+        limit (int, optional): Maximum number of turns kept in the pack. Defaults to MAX_CONTEXT_TURNS.
+    """
+    cache_key = (channel_id, model_id)
+    lock = _context_locks.get(cache_key)
+    if lock is None:
+        lock = _context_locks[cache_key] = asyncio.Lock()
+    
+    # Serialize appends so stored packs are committed in the order they were built
+    async with lock:
+        try:
+            budget = int(CONTEXT_BUDGET_RATIO * context_tokens)
+            window = await _get_context_window(db, channel_id, model_id, limit, budget)
+            window.append((question, answer))
+            _trim_context_window(window, limit, budget)
+            
+            # Persist the pack for durability and cold starts only
+            stmt = pg_insert(ConversationContext).values(
+                channel_id=channel_id,
+                model_name=model_id,
+                turns=[list(turn) for turn in window],
+                version=1
+            )
+            stmt = stmt.on_conflict_do_update(
+                constraint="uq_conversation_contexts_channel_model",
+                set_={
+                    "turns": stmt.excluded.turns,
+                    "version": ConversationContext.version + 1,
+                    "updated_at": func.now()
+                }
+            )
+            await db.execute(stmt)
+            await db.commit()
+        except Exception as e:
+            logger.error(f"Error storing memory pack: {str(e)}")
+            await db.rollback()